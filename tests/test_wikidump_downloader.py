@@ -0,0 +1,46 @@
+import sys
+
+# the module parses the command line on import
+sys.argv = sys.argv[:1]
+
+import wikidump_downloader as wd  # noqa: E402
+
+
+def step(controller, rate, error_rate=0):
+    delta = controller.adjust(rate, error_rate)
+    controller.active += delta
+    return delta
+
+
+def test_adjust_keeps_starting_workers_and_probes_again():
+    controller = wd.ConcurrencyController(3, 12)
+    # a probe without gain is given back
+    assert step(controller, 10) == 1
+    assert step(controller, 10) == -1
+    assert controller.active == 3
+    # failing windows never retire below the starting workers
+    assert step(controller, 10, error_rate=0.5) == 0
+    assert step(controller, 10, error_rate=0.5) == 0
+    assert controller.active == 3
+    # healthy windows probe again once the cooldown is over
+    deltas = [step(controller, 10) for _ in range(20)]
+    assert 1 in deltas
+    assert controller.active >= 3
+
+
+def test_adjust_grows_only_while_probes_pay_off():
+    controller = wd.ConcurrencyController(3, 5)
+    assert step(controller, 0) == 0
+    assert step(controller, 10) == 1
+    assert step(controller, 12) == 1
+    assert step(controller, 20) == 0
+    assert controller.active == 5
+
+
+def test_error_rate_counts_finished_files():
+    controller = wd.ConcurrencyController(3, 12)
+    assert controller.error_rate() == 0
+    for failed in [False] * 19 + [True]:
+        controller.add_file(failed)
+    assert controller.error_rate() == 0.05
+    assert step(controller, 10, controller.error_rate()) == 1
@@ -1,14 +1,37 @@
 import argparse
+import base64
+import collections
+import email.utils
 import glob
 import hashlib
+import http.client
+import io
+import itertools
 import json
 import logging
+import math
 import os
+import pickle
+import queue
+import random
 import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 from datetime import datetime
 import pathlib
 
+try:
+    import fcntl
+except ImportError:  # not available on windows, downloads are left unlocked
+    fcntl = None
+
 parser = argparse.ArgumentParser(description="WikiDump Downloader")
 parser.add_argument(
     "--data-path", type=str, default="./data/", help="the data directory"
@@ -44,6 +67,30 @@ logging.basicConfig(
     format="(%(threadName)s) %(message)s",
 )
 
+# read size used when hashing dump files, small enough to stay in L2 cache
+HASH_CHUNK = 1 << 18
+
+# read size used when streaming a dump file to disk
+DOWNLOAD_CHUNK = 1 << 20
+# abort a download that stays under LOW_SPEED_LIMIT bytes/s for LOW_SPEED_TIME seconds
+LOW_SPEED_LIMIT = 100 * 1024
+LOW_SPEED_TIME = 30
+# upper bound in seconds of the backoff after every mirror failed a file
+BACKOFF_MAX = 60
+# seconds before a connect or read on a download connection times out
+HTTP_TIMEOUT = 30
+# seconds between two concurrency adjustments of the download workers
+ADJUST_INTERVAL = 10
+# windows to wait after a probe without gain before adding workers again
+PROBE_COOLDOWN = 6
+# number of recently finished files the download error rate is taken over
+ERROR_WINDOW_FILES = 20
+# hard cap of concurrent downloads, to stay clear of per-host bans
+MAX_WORKERS = 16
+
+# number of lowest-latency mirrors used in rotation, the rest are fallbacks
+MIRROR_FAST_NUM = 3
+
 WIKIMEDIA_MIRRORS = [
     "https://dumps.wikimedia.org",
     "https://wikimedia.bringyour.com",
@@ -54,101 +101,599 @@ WIKIMEDIA_MIRRORS = [
 ]
 
 
-class wikipediaMirror:
+class WikipediaMirror:
+    """
+    hand out mirrors round-robin. next() on an itertools.cycle runs in C
+    under the GIL, so workers can share it without a lock.
+    """
+
     def __init__(self):
-        self.index = 0
+        self.mirrors = list(WIKIMEDIA_MIRRORS)
+        self._it = itertools.cycle(self.mirrors)
 
-    def get_mirror(self):
+    def rank(self, ranked_mirrors, fast_num):
+        """
+        rotate over the fast_num fastest mirrors only, the slower ones are
+        kept at the end of self.mirrors as last-resort fallbacks.
+        """
+        self.mirrors = list(ranked_mirrors)
+        self._it = itertools.cycle(self.mirrors[:fast_num])
 
-        if self.index < len(WIKIMEDIA_MIRRORS) - 1:
-            self.index += 1
+    def get_mirror(self):
+        return next(self._it)
+
+    def mirror_order(self):
+        """
+        the order to try mirrors for one file: the next mirror in rotation,
+        then every other mirror by rank.
+        """
+        first = self.get_mirror()
+        return [first] + [m for m in self.mirrors if m != first]
+
+
+def probe(mirror):
+    """
+    return the round trip time of a HEAD request to mirror, inf on failure.
+    a 4xx status still is an answer, so it counts as reachable. a 5xx
+    status comes from a failing backend and counts as unreachable.
+    """
+    req = urllib.request.Request(mirror + "/", method="HEAD")
+    t0 = time.monotonic()
+    try:
+        with urllib.request.urlopen(req, timeout=2) as resp:
+            resp.read(0)
+    except urllib.error.HTTPError as e:
+        e.close()
+        if e.code >= 500:
+            logging.debug("probe mirror fail: %s %s", mirror, e)
+            return math.inf
+    except Exception as e:
+        logging.debug("probe mirror fail: %s %s", mirror, e)
+        return math.inf
+    return time.monotonic() - t0
+
+
+def rank_mirrors(data_path):
+    """
+    sort WIKIMEDIA_MIRRORS by latency, the result is cached in
+    data_path/mirrors.json for the current week.
+    """
+    week = "%d-W%02d" % datetime.now().isocalendar()[:2]
+    cache_file = data_path.joinpath("mirrors.json")
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if cache.get("week") == week and set(cache["mirrors"]) == set(
+            WIKIMEDIA_MIRRORS
+        ):
+            return cache["mirrors"]
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        # a missing or corrupt cache is probed again and rewritten
+        logging.debug("mirror cache miss: %s", e)
+
+    with ThreadPoolExecutor(len(WIKIMEDIA_MIRRORS)) as executor:
+        rtts = list(executor.map(probe, WIKIMEDIA_MIRRORS))
+    for mirror, rtt in zip(WIKIMEDIA_MIRRORS, rtts):
+        logging.info("mirror %s rtt: %.3fs", mirror, rtt)
+    # sorted() is stable, unreachable mirrors keep their original order at the end
+    ranked = [m for _, m in sorted(zip(rtts, WIKIMEDIA_MIRRORS), key=lambda x: x[0])]
+
+    with open(cache_file, "wt") as f:
+        json.dump({"week": week, "mirrors": ranked}, f)
+    return ranked
+
+
+WM = WikipediaMirror()
+
+
+def build_opener(proxies):
+    """
+    build the url opener used by the mirror probes, so they go through the
+    same proxy as the downloads. the downloads themselves use ConnectionPool.
+    """
+    handlers = []
+    if proxies:
+        proxy_setting = {"http": proxies, "https": proxies}
+        handlers.append(urllib.request.ProxyHandler(proxy_setting))
+    return urllib.request.build_opener(*handlers)
+
+
+class ConnectionPool:
+    """
+    keep-alive http connections, one set per thread and mirror host, so
+    consecutive files from the same mirror reuse the TCP and TLS session.
+    connections are never shared between threads.
+    """
+
+    def __init__(self, proxies=""):
+        if proxies:
+            self.proxies = {"http": proxies, "https": proxies}
+        else:
+            self.proxies = urllib.request.getproxies()
+        self._local = threading.local()
+
+    def _conns(self):
+        if not hasattr(self._local, "conns"):
+            self._local.conns = {}
+        return self._local.conns
+
+    def _connect(self, scheme, host, port):
+        """
+        return (connection, whether requests need the absolute url,
+        extra headers for every request).
+        """
+        proxy = self.proxies.get(scheme)
+        if proxy and not urllib.request.proxy_bypass(host):
+            # the same proxy forms ProxyHandler accepts: host:port,
+            # http://host:port and user:pass@host:port
+            if "://" not in proxy:
+                proxy = "http://" + proxy
+            proxy = urllib.parse.urlsplit(proxy)
+            proxy_headers = {}
+            if proxy.username and proxy.password is not None:
+                credentials = "%s:%s" % (
+                    urllib.parse.unquote(proxy.username),
+                    urllib.parse.unquote(proxy.password),
+                )
+                proxy_headers["Proxy-Authorization"] = (
+                    "Basic " + base64.b64encode(credentials.encode()).decode("ascii")
+                )
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(
+                    proxy.hostname, proxy.port, timeout=HTTP_TIMEOUT
+                )
+                conn.set_tunnel(host, port, headers=proxy_headers)
+                return conn, False, {}
+            conn = http.client.HTTPConnection(
+                proxy.hostname, proxy.port, timeout=HTTP_TIMEOUT
+            )
+            return conn, True, proxy_headers
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(host, port, timeout=HTTP_TIMEOUT)
         else:
-            self.index = 0
-        return WIKIMEDIA_MIRRORS[self.index]
+            conn = http.client.HTTPConnection(host, port, timeout=HTTP_TIMEOUT)
+        return conn, False, {}
+
+    def discard(self, url):
+        """
+        close the connection to the host of url, e.g. after a body was only
+        partly read and the connection can't be reused.
+        """
+        parts = urllib.parse.urlsplit(url)
+        conn = self._conns().pop((parts.scheme, parts.netloc), None)
+        if conn:
+            conn[0].close()
+
+    def _request(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        conns = self._conns()
+        # a kept-alive connection may have been closed by the server meanwhile,
+        # give it one more try on a fresh connection
+        for reused in (key in conns, False):
+            if key not in conns:
+                conns[key] = self._connect(parts.scheme, parts.hostname, parts.port)
+            conn, absolute, proxy_headers = conns[key]
+            path = url if absolute else urllib.parse.urlunsplit(("", "") + parts[2:])
+            try:
+                conn.request("GET", path or "/", headers={**headers, **proxy_headers})
+                return conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                self.discard(url)
+                if not reused:
+                    raise
+
+    def open(self, url, headers=None, max_redirects=5):
+        """
+        GET url following redirects and return (http.client.HTTPResponse,
+        the final url), the latter names the connection to discard() when
+        the body is abandoned. raise urllib.error.HTTPError for error
+        statuses like urlopen does.
+        """
+        headers = {"User-Agent": "wikidump-downloader", **(headers or {})}
+        for _ in range(max_redirects + 1):
+            resp = self._request(url, headers)
+            if resp.status in (301, 302, 303, 307, 308):
+                resp.read()
+                url = urllib.parse.urljoin(url, resp.getheader("Location"))
+                continue
+            if resp.status >= 400:
+                body = resp.read()
+                raise urllib.error.HTTPError(
+                    url, resp.status, resp.reason, resp.headers, io.BytesIO(body)
+                )
+            return resp, url
+        raise http.client.HTTPException("too many redirects: " + url)
+
+
+class LowSpeedError(Exception):
+    pass
+
+
+class DownloadInterrupted(Exception):
+    pass
+
+
+def fetch(dump_url, file_name, pool, controller=None, interrupted=None):
+    """
+    stream dump_url into file_name and return the md5 of the whole file,
+    hashed while the bytes are written. raise LowSpeedError when the mirror
+    is too slow so the caller can switch to another mirror, and
+    DownloadInterrupted once interrupted is set.
+    a partial file_name is resumed with a Range request.
+    """
+    offset = file_name.stat().st_size if file_name.exists() else 0
+    # hash the partial file before the request, not while its body waits unread
+    hash_md5 = md5_hash(file_name) if offset else hashlib.md5()
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    try:
+        resp, resp_url = pool.open(dump_url, headers)
+    except urllib.error.HTTPError as e:
+        # the partial file already holds every byte
+        if offset and e.code == 416:
+            return hash_md5.hexdigest()
+        raise
+
+    # 206 continues the partial file, 200 means the range was ignored
+    if resp.status == 206:
+        content_range = resp.getheader("Content-Range", "")
+        if not content_range.startswith(f"bytes {offset}-"):
+            pool.discard(resp_url)
+            raise ValueError(f"unexpected Content-Range {content_range!r}: {dump_url}")
+        mode = "ab"
+    else:
+        mode = "wb"
+        hash_md5 = hashlib.md5()
+    try:
+        with open(file_name, mode) as f:
+            bytes_since, t0 = 0, time.monotonic()
+            for chunk in iter(lambda: resp.read(DOWNLOAD_CHUNK), b""):
+                if interrupted and interrupted.is_set():
+                    raise DownloadInterrupted(dump_url)
+                f.write(chunk)
+                hash_md5.update(chunk)
+                bytes_since += len(chunk)
+                if controller:
+                    controller.add_bytes(len(chunk))
+                elapsed = time.monotonic() - t0
+                if elapsed >= LOW_SPEED_TIME:
+                    if bytes_since / elapsed < LOW_SPEED_LIMIT:
+                        raise LowSpeedError(
+                            f"{bytes_since / elapsed:.0f} B/s from {dump_url}"
+                        )
+                    bytes_since, t0 = 0, time.monotonic()
+    except BaseException:
+        # the rest of the body is still on the wire, drop the connection
+        pool.discard(resp_url)
+        raise
+    return hash_md5.hexdigest()
 
 
-WM = wikipediaMirror()
+def md5_sidecar(file_name):
+    """
+    the file holding the md5 of file_name computed while it was downloaded.
+    """
+    return file_name.with_suffix(file_name.suffix + ".md5")
 
 
-def download(dump_status_file, data_path, compress_type, start, end, thread_num):
-    url_list = []
-    file_list = []
+def update_dump_status(url, dump_status_file):
+    """
+    fetch dumpstatus.json, but only rewrite dump_status_file when it changed,
+    so the index pickled by load_index stays valid between runs.
+    """
+    headers = {}
+    if dump_status_file.exists():
+        headers["If-Modified-Since"] = email.utils.formatdate(
+            dump_status_file.stat().st_mtime, usegmt=True
+        )
+    try:
+        req = urllib.request.Request(url, headers=headers)
+        with urllib.request.urlopen(req) as resp:
+            data = resp.read()
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            logging.info("dumpstatus.json not modified")
+            return
+        raise
+
+    if dump_status_file.exists() and dump_status_file.read_bytes() == data:
+        logging.info("dumpstatus.json unchanged")
+        return
+    dump_status_file.write_bytes(data)
+
+
+def load_index(dump_status_file, compress_type):
+    """
+    return {file: (url, md5)} of the history dump, the parsed result
+    is pickled next to dump_status_file and reused while it is newer.
+    """
+    index_file = dump_status_file.with_name(f"dumpstatus.{compress_type}.pkl")
+    try:
+        if index_file.stat().st_mtime >= dump_status_file.stat().st_mtime:
+            with open(index_file, "rb") as f:
+                return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+        # a missing or corrupt cache is parsed again and rewritten
+        logging.debug("index cache miss: %s", e)
+
     with open(dump_status_file) as json_data:
         # Two dump types: compressed by 7z (metahistory7zdump) or bz2 (metahistorybz2dump)
         history_dump = json.load(json_data)["jobs"][
             "metahistory" + compress_type + "dump"
         ]
-        dump_dict = history_dump["files"]
-        dump_files = sorted(list(dump_dict.keys()))
+    index = {
+        file: (value["url"], value["md5"])
+        for file, value in history_dump["files"].items()
+    }
+    # write aside and swap in, so a crash never leaves a truncated cache behind
+    tmp_file = index_file.with_name(f"{index_file.name}.{os.getpid()}.tmp")
+    with open(tmp_file, "wb") as f:
+        pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, index_file)
+    return index
+
+
+class ConcurrencyController:
+    """
+    ramp the number of active download workers up and down.
+
+    workers hold a permit of self.sem while downloading a file. every
+    ADJUST_INTERVAL seconds one permit is retired if more than 5% of the
+    recently finished files needed a mirror failover. otherwise one more
+    permit is released as a probe, and another one only if the throughput
+    grew by more than 10% over the rate before the last probe. a probe that
+    brought no gain is retired again, and probing resumes after
+    PROBE_COOLDOWN windows. the workers never drop below the starting count.
+    """
+
+    def __init__(self, workers, max_workers):
+        self.lock = threading.Lock()
+        self.sem = threading.Semaphore(workers)
+        self.active = workers
+        self.min_workers = workers
+        self.max_workers = max_workers
+        self.bytes = 0
+        # whether each of the last finished files needed a failover
+        self.results = collections.deque(maxlen=ERROR_WINDOW_FILES)
+        # throughput before the last added permit, None when no probe is pending
+        self.bump_rate = None
+        self.cooldown = 0
+        self._retire = 0
+        self._stop = threading.Event()
+
+    def acquire(self):
+        self.sem.acquire()
+
+    def release(self):
+        with self.lock:
+            if self._retire:
+                self._retire -= 1
+                return
+        self.sem.release()
+
+    def add_bytes(self, n):
+        with self.lock:
+            self.bytes += n
+
+    def add_file(self, failed):
+        with self.lock:
+            self.results.append(failed)
+
+    def error_rate(self):
+        return sum(self.results) / len(self.results) if self.results else 0
+
+    def adjust(self, rate, error_rate):
+        """
+        return +1 to add a permit, -1 to retire one, 0 to keep the workers.
+        """
+        if error_rate > 0.05:
+            self.bump_rate = None
+            # judge the next retire on files finished after this one
+            self.results.clear()
+            return -1 if self.active > self.min_workers else 0
+        if self.bump_rate is not None:
+            gain = rate > self.bump_rate * 1.1
+            if gain and self.active < self.max_workers:
+                self.bump_rate = rate
+                return 1
+            self.bump_rate = None
+            if not gain:
+                # the last permit did not pay off, give it back for a while
+                self.cooldown = PROBE_COOLDOWN
+                return -1 if self.active > self.min_workers else 0
+            return 0
+        if self.cooldown:
+            self.cooldown -= 1
+            return 0
+        # an idle window (rate 0) is no baseline to probe from
+        if rate > 0 and self.active < self.max_workers:
+            self.bump_rate = rate
+            return 1
+        return 0
+
+    def run(self):
+        while not self._stop.wait(ADJUST_INTERVAL):
+            with self.lock:
+                rate = self.bytes / ADJUST_INTERVAL
+                self.bytes = 0
+                error_rate = self.error_rate()
+                delta = self.adjust(rate, error_rate)
+                self.active += delta
+                if delta < 0:
+                    self._retire += 1
+            if delta > 0:
+                self.sem.release()
+            logging.info(
+                "throughput %.2f MB/s, error rate %.1f%%, workers %d",
+                rate / 1e6,
+                error_rate * 100,
+                self.active,
+            )
+
+    def stop(self):
+        self._stop.set()
+
+
+def download(
+    dump_status_file, data_path, compress_type, start, end, thread_num, proxies
+):
+    url_list = []
+    file_list = []
+    md5_list = []
+    dump_dict = load_index(dump_status_file, compress_type)
+    dump_files = sorted(dump_dict)
 
-        if args.end > 0 and args.end <= len(dump_files):
-            dump_files = dump_files[start - 1 : end]
-        else:
-            dump_files = dump_files[start - 1 :]
-
-        # print all files to be downloaded.
-        print("All files to download ...")
-        for i, file in enumerate(dump_files):
-            print(i + args.start, file)
-
-        file_num = 0
-        for dump_file in dump_files:
-            file_name = data_path.joinpath(dump_file)
-            file_list.append(file_name)
-
-            # url example: https://dumps.wikimedia.org/enwiki/20180501/enwiki-20180501-pages-meta-history1.xml-p10p2123.7z
-            # url = "https://dumps.wikimedia.org" + dump_dict[dump_file]['url']
-            url = dump_dict[dump_file]["url"]
-            url_list.append(url)
-            file_num += 1
-
-        print("Total file ", file_num, " to be downloaded ...")
-        json_data.close()
-
-    task = WikiDumpTask(file_list, url_list)
-    threads = []
-    for i in range(thread_num):
-        t = threading.Thread(target=worker, args=(i, task))
-        threads.append(t)
-        t.start()
+    if end > 0 and end <= len(dump_files):
+        dump_files = dump_files[start - 1 : end]
+    else:
+        dump_files = dump_files[start - 1 :]
+
+    # print all files to be downloaded.
+    print("All files to download ...")
+    for i, file in enumerate(dump_files):
+        print(i + start, file)
+
+    # one scandir of data_path instead of a stat per file in the workers,
+    # finished files are skipped here and only .part files get resumed
+    existing = {entry.name for entry in os.scandir(data_path)}
+
+    file_num = 0
+    for dump_file in dump_files:
+        if dump_file in existing:
+            logging.debug("File Exists, Skip: " + dump_file)
+            continue
+        file_name = data_path.joinpath(dump_file)
+        file_list.append(file_name)
+
+        # url example: https://dumps.wikimedia.org/enwiki/20180501/enwiki-20180501-pages-meta-history1.xml-p10p2123.7z
+        # url = "https://dumps.wikimedia.org" + dump_dict[dump_file]['url']
+        url, gt_md5 = dump_dict[dump_file]
+        url_list.append(url)
+        md5_list.append(gt_md5)
+        file_num += 1
+
+    print("Total file ", file_num, " to be downloaded ...")
+    if not file_num:
+        return
 
-    logging.debug("Waiting for worker threads")
-    main_thread = threading.current_thread()
-    for t in threading.enumerate():
-        if t is not main_thread:
-            t.join()
+    # Install the opener as the default opener for the mirror probes,
+    # the downloads go through a pool of per-thread keep-alive connections
+    urllib.request.install_opener(build_opener(proxies))
+    WM.rank(rank_mirrors(data_path), MIRROR_FAST_NUM)
+    pool = ConnectionPool(proxies)
+
+    # start thread_num permits, spare threads wait until the controller adds more
+    max_workers = max(thread_num, min(len(WM.mirrors) * 2, MAX_WORKERS))
+    controller = ConcurrencyController(thread_num, max_workers)
+    threading.Thread(target=controller.run, name="controller", daemon=True).start()
+
+    # set on Ctrl-C, tasks still waiting for a permit return without downloading
+    interrupted = threading.Event()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                download_one,
+                url,
+                file_name,
+                gt_md5,
+                pool,
+                controller,
+                WM.mirror_order,
+                interrupted,
+            ): url
+            for url, file_name, gt_md5 in zip(url_list, file_list, md5_list)
+        }
+        try:
+            for i, future in enumerate(as_completed(futures), 1):
+                future.result()
+                logging.debug(
+                    "Finished task ("
+                    + str(i)
+                    + "/"
+                    + str(file_num)
+                    + "): "
+                    + futures[future]
+                )
+        except KeyboardInterrupt:
+            # drop the queued files and stop the ones waiting for a permit,
+            # running downloads stop at their next chunk and keep the .part file
+            interrupted.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            controller.stop()
 
 
 def md5(file):
+    return md5_hash(file).hexdigest()
+
+
+def md5_hash(file):
+    """
+    return the md5 hash object of file, so callers can keep feeding it.
+    the reader thread keeps up to two chunks queued while this thread hashes,
+    so disk reads and hashing overlap instead of taking turns.
+    """
     hash_md5 = hashlib.md5()
+    chunks = queue.Queue(maxsize=2)
+    errors = []
+
+    def reader(f):
+        try:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                chunks.put(chunk)
+        except OSError as e:
+            errors.append(e)
+        finally:
+            chunks.put(b"")
+
     with open(file, "rb") as f:
-        for chunk in iter(lambda: f.read(40960000), b""):
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        t = threading.Thread(target=reader, args=(f,), daemon=True)
+        t.start()
+        while chunk := chunks.get():
             hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+        t.join()
+    if errors:
+        raise errors[0]
+    return hash_md5
 
 
 def verify(dump_status_file, compress_type, data_path: pathlib.Path):
     print("Verify the file in folder:", data_path)
     pass_files, miss_files, crash_files = [], [], []
-    with open(dump_status_file) as json_data:
-        # Two dump types: compressed by 7z (metahistory7zdump) or bz2 (metahistorybz2dump)
-        history_dump = json.load(json_data)["jobs"][
-            "metahistory" + compress_type + "dump"
-        ]
-        dump_dict = history_dump["files"]
-        for i, (file, value) in enumerate(dump_dict.items()):
-            gt_md5 = value["md5"]
-            print("#", i, " ", file, " ", value["md5"], sep="")
-            file_path = data_path.joinpath(file)
-            if file_path.exists():
-                file_md5 = md5(file_path)
-                if file_md5 == gt_md5:
-                    pass_files.append(file)
-                else:
-                    crash_files.append(file)
-                    os.remove(file_path)
+    dump_dict = load_index(dump_status_file, compress_type)
+
+    # collect the files on disk first, then hash them in parallel.
+    # a file with a sidecar newer than itself was hashed during download
+    pairs = []
+    for file, (_, gt_md5) in dump_dict.items():
+        file_path = data_path.joinpath(file)
+        sidecar = md5_sidecar(file_path)
+        if not file_path.exists():
+            miss_files.append(file)
+        elif (
+            sidecar.exists()
+            and sidecar.stat().st_mtime >= file_path.stat().st_mtime
+            and sidecar.read_text() == gt_md5
+        ):
+            pass_files.append(file)
+        else:
+            pairs.append((file, gt_md5, file_path))
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        file_md5s = executor.map(md5, [file_path for _, _, file_path in pairs])
+        for i, ((file, gt_md5, file_path), file_md5) in enumerate(
+            zip(pairs, file_md5s)
+        ):
+            print("#", i, " ", file, " ", gt_md5, sep="")
+            if file_md5 == gt_md5:
+                pass_files.append(file)
             else:
-                miss_files.append(file)
+                crash_files.append(file)
+                os.remove(file_path)
+                md5_sidecar(file_path).unlink(missing_ok=True)
 
     print(
         len(pass_files),
@@ -182,8 +727,7 @@ def main():
     logging.info("start version: %s, data path: %s", version_flag, data_path)
 
     dump_status_file = data_path.joinpath("dumpstatus.json")
-    # if not dump_status_file.exists():
-    urllib.request.urlretrieve(
+    update_dump_status(
         f"https://dumps.wikimedia.org/enwiki/{version_flag}/dumpstatus.json",
         dump_status_file,
     )
@@ -208,84 +752,101 @@ def main():
             args.start,
             args.end,
             args.threads,
+            args.proxies,
         )
 
 
-"""
-WikiDumpTask class contains a list of dump files to be downloaded . 
-The assign_task function will be called by workers to grab a task.
-"""
-
-
-class WikiDumpTask(object):
-    def __init__(self, file_list, url_list):
-        self.lock = threading.Lock()
-        self.url_list = url_list
-        self.file_list = file_list
-        self.total_num = len(url_list)
-
-    def assign_task(self):
-        logging.debug("Assign tasks ... Waiting for lock")
-        self.lock.acquire()
-        url = None
-        file_name = None
-        cur_progress = None
-        try:
-            # logging.debug('Acquired lock')
-            if len(self.url_list) > 0:
-                url = self.url_list.pop(0)
-                file_name = self.file_list.pop(0)
-                cur_progress = self.total_num - len(self.url_list)
-        finally:
-            self.lock.release()
-        return url, file_name, cur_progress, self.total_num
-
-
-"""
-worker is main function for each thread.
-"""
-
-
-def worker(work_id, tasks):
-    logging.debug("Starting.")
-    if args.proxies:
-
-        proxy_setting = {"http": args.proxies, "https": args.proxies}
-        proxy_handler = urllib.request.ProxyHandler(proxy_setting)
-        opener = urllib.request.build_opener(proxy_handler)
-    # Install the opener as the default opener
-    urllib.request.install_opener(opener)
-
-    # grab one task from task_list
+def fetch_verified(dump_urls, part_name, gt_md5, pool, controller, interrupted):
+    """
+    try the mirrors one after another, failing over on the first error.
+    only when all of them failed, back off and start over.
+    return once part_name is complete and its md5 matches gt_md5, raise
+    DownloadInterrupted once interrupted is set.
+    """
+    attempt = 0
+    failed = False
     while 1:
-        url, file_name, cur_progress, total_num = tasks.assign_task()
-        if not url:
-            break
-        logging.debug(
-            "Assigned task ("
-            + str(cur_progress)
-            + "/"
-            + str(total_num)
-            + "): "
-            + str(url)
-        )
-
+        for dump_url in dump_urls:
+            try:
+                logging.debug("start get file: " + dump_url)
+                file_md5 = fetch(dump_url, part_name, pool, controller, interrupted)
+                if file_md5 != gt_md5:
+                    # truncate instead of delete, so the lock stays on this file
+                    os.truncate(part_name, 0)
+                    raise ValueError(f"md5 mismatch: {dump_url}")
+                controller.add_file(failed)
+                return file_md5
+            except DownloadInterrupted:
+                raise
+            except Exception as e:
+                failed = True
+                logging.warning("download fail, try next mirror: %s", e)
+        backoff = random.uniform(0, min(BACKOFF_MAX, 2**attempt))
+        logging.warning("all mirrors fail: %s, retry in %.1fs", dump_urls[0], backoff)
+        if interrupted.wait(backoff):
+            raise DownloadInterrupted(dump_urls[0])
+        attempt += 1
+
+
+def download_file(
+    url, file_name, gt_md5, pool, controller, mirror_order, interrupted
+):
+    """
+    download into file_name.part, and promote it to file_name with an atomic
+    os.replace once its md5 matches gt_md5.
+    return False if another worker holds the lock of the .part file, or the
+    download was interrupted. the .part file is then resumed on the next run.
+    """
+    part_name = file_name.with_suffix(file_name.suffix + ".part")
+    with open(part_name, "ab") as lock_file:
+        if fcntl:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.warning("File Locked, Skip: " + url)
+                return False
+
+        # the mirror urls of this file are built once, not on every retry
+        dump_urls = [mirror + url for mirror in mirror_order()]
+        try:
+            file_md5 = fetch_verified(
+                dump_urls, part_name, gt_md5, pool, controller, interrupted
+            )
+        except DownloadInterrupted:
+            logging.info("Download Interrupted, keep: " + str(part_name))
+            return False
+        # written first, so a promoted file always has its sidecar
+        md5_sidecar(file_name).write_text(file_md5)
+        if fcntl:
+            # still under the lock, so no other process picks up the .part file
+            os.replace(part_name, file_name)
+    if not fcntl:
+        # windows refuses to rename a file that is still open
+        os.replace(part_name, file_name)
+    return True
+
+
+def download_one(
+    url, file_name, gt_md5, pool, controller, mirror_order, interrupted
+):
+    """
+    download one dump file, holding a controller permit while working on it.
+    """
+    controller.acquire()
+    try:
+        if interrupted.is_set():
+            return
+        logging.debug("Assigned task: " + url)
+        # file_name only appears once its md5 matched, partial data lives in .part
         if not file_name.exists():
-            while 1:
-                try:
-                    dump_url = WM.get_mirror() + url
-                    logging.debug("start get file: " + dump_url)
-                    urllib.request.urlretrieve(dump_url, file_name)
-                    logging.debug("File Downloaded: " + url)
-                    break
-                except Exception as e:
-                    logging.warning("download fiale, retry: %s", e)
-
+            if download_file(
+                url, file_name, gt_md5, pool, controller, mirror_order, interrupted
+            ):
+                logging.debug("File Downloaded: " + url)
         else:
             logging.debug("File Exists, Skip: " + url)
-    logging.debug("Exiting.")
-
-    return
+    finally:
+        controller.release()
 
 
 if __name__ == "__main__":